@@ -105,10 +105,13 @@ class Discriminator(nn.Module):
 			nn.Conv2d(1024, 1, kernel_size=1)
 		)
 
-	def forward(self, x): 
+	def forward(self, x, logits=False): 
 		#print ('D input size :' +  str(x.size()))
 		y = self.net(x)
 		#print ('D output size :' +  str(y.size()))
+		# Pre-sigmoid output, so the loss can apply the sigmoid in float32
+		if logits:
+			return y.view(y.size()[0])
 		si = torch.sigmoid(y).view(y.size()[0])
 		#print ('D output : ' + str(si))
 		return si
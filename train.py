@@ -2,12 +2,15 @@ import os
 import argparse
 import time
 import numpy as np
+import multiprocessing
 
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 from tqdm import tqdm
 from tensorboard_logger import configure, log_value
 
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
 import torch.optim as optim
 
 import torch.utils.data
@@ -16,14 +19,40 @@ from torch.utils.data import DataLoader
 import torchvision.utils as utils
 from torchvision.transforms import Normalize
 
-from math import log10
 import pytorch_ssim
 
 from model import Generator, Discriminator
 
-from utils import TrainDataset, DevDataset, to_image, print_first_parameter, check_grads, get_grads_D, get_grads_G
+from utils import TrainDataset, DevDataset, print_first_parameter, check_grads, get_grads_D, get_grads_G, cpu_state_dict, save_grid
 
-def main():
+def save_async(executor, net, path):
+	# Checkpoints are written in the background so training does not wait on disk
+	return executor.submit(torch.save, cpu_state_dict(net), path)
+
+def wait_all(futures):
+	# Re-raises the first error of the background work, like a synchronous call would
+	for future in futures:
+		future.result()
+	del futures[:]
+
+def make_adam(params):
+	# Fused CUDA Adam updates every parameter in a single kernel (PyTorch >= 1.13)
+	params = list(params)
+	try:
+		return optim.Adam(params, fused=torch.cuda.is_available())
+	except TypeError:
+		pass
+	# PyTorch 1.12 has the multi-tensor path behind foreach, off by default
+	try:
+		return optim.Adam(params, foreach=True)
+	except TypeError:
+		pass
+	# Older releases ship it as a separate optimizer
+	if hasattr(optim, '_multi_tensor'):
+		return optim._multi_tensor.Adam(params)
+	return optim.Adam(params)
+
+def main(checkpoint_executor, image_executor):
 	n_epoch_pretrain = 2
 	use_tensorboard = True
 
@@ -42,21 +71,37 @@ def main():
 	check_point = opt.check_point
 
 	check_point_path = 'cp/'
+	suffix = 'gpu' if torch.cuda.is_available() else 'cpu'
 	if not os.path.exists(check_point_path):
 		os.makedirs(check_point_path)
 
+	device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+	use_compile = torch.cuda.is_available() and hasattr(torch, 'compile')
+
 	train_set = TrainDataset(opt.train_set, crop_size=input_size, upscale_factor=4)
-	train_loader = DataLoader(dataset=train_set, num_workers=2, batch_size=batch_size, shuffle=True)
+	# drop_last keeps every batch the same shape for the compiled models
+	train_loader = DataLoader(dataset=train_set, num_workers=min(8, os.cpu_count() or 1), batch_size=batch_size, shuffle=True, pin_memory=torch.cuda.is_available(), persistent_workers=True, prefetch_factor=4, drop_last=use_compile)
+	if len(train_loader) == 0:
+		raise ValueError('train set %s has %d images, fewer than one batch of %d' % (opt.train_set, len(train_set), batch_size))
 
 	dev_set = DevDataset('data/dev', upscale_factor=4)
-	dev_loader = DataLoader(dataset=dev_set, num_workers=1, batch_size=1, shuffle=False)
+	dev_loader = DataLoader(dataset=dev_set, num_workers=2, batch_size=1, shuffle=False, pin_memory=torch.cuda.is_available(), persistent_workers=True, prefetch_factor=4)
 
 	mse = nn.MSELoss()
-	bce = nn.BCELoss()
+	bce = nn.BCEWithLogitsLoss()
 	#tv = TVLoss()
 		
 	if not torch.cuda.is_available():
 		print ('!!!!!!!!!!!!!!USING CPU!!!!!!!!!!!!!')
+	else:
+		# Train crops and center-cropped dev images have fixed sizes, let cudnn autotune for them
+		torch.backends.cudnn.benchmark = True
+	
+	# bf16 keeps the fp32 exponent range, so Ampere and newer GPUs need no loss scaling.
+	# Its short mantissa is why the discriminator losses are computed from float32 logits.
+	use_bf16 = torch.cuda.is_available() and torch.cuda.get_device_capability(0)[0] >= 8
+	autocast_dtype = torch.bfloat16 if use_bf16 else torch.float16
+	use_scaler = torch.cuda.is_available() and not use_bf16
 
 	netG = Generator()
 	print('# generator parameters:', sum(param.numel() for param in netG.parameters()))
@@ -66,16 +111,28 @@ def main():
 	if torch.cuda.is_available():
 		netG.cuda()
 		netD.cuda()
+		# NHWC layout lets cudnn use Tensor Core convolutions
+		netG.to(memory_format=torch.channels_last)
+		netD.to(memory_format=torch.channels_last)
 		#tv.cuda()
 		mse.cuda()
 		bce.cuda()
 	
+	# Compiled wrappers are only used for the training forwards, the plain
+	# modules keep their parameter names for checkpoints and gradient logging
+	forwardG = netG
+	forwardD = netD
+	if use_compile:
+		forwardG = torch.compile(netG, dynamic=False)
+		forwardD = torch.compile(netD, dynamic=False)
+	
 	if use_tensorboard:
 		configure('log', flush_secs=5)
 	
 	# Pre-train generator using only MSE loss
 	if check_point == -1:
-		optimizerG = optim.Adam(netG.parameters())
+		optimizerG = make_adam(netG.parameters())
+		scalerG = torch.cuda.amp.GradScaler(enabled=use_scaler)
 		#schedulerG = MultiStepLR(optimizerG, milestones=[20], gamma=0.1)
 		for epoch in range(1, n_epoch_pretrain + 1):
 			#schedulerG.step()		
@@ -83,49 +140,53 @@ def main():
 			
 			netG.train()
 			
-			cache = {'g_loss': 0}
+			cache = {'g_loss': torch.zeros((), device=device)}
 			
-			for lowres, real_img_hr in train_bar:
+			for i, (lowres, real_img_hr) in enumerate(train_bar):
 				if torch.cuda.is_available():
-					real_img_hr = real_img_hr.cuda()
+					real_img_hr = real_img_hr.cuda(non_blocking=True).contiguous(memory_format=torch.channels_last)
 					
 				if torch.cuda.is_available():
-					lowres = lowres.cuda()
+					lowres = lowres.cuda(non_blocking=True).contiguous(memory_format=torch.channels_last)
 					
-				fake_img_hr = netG(lowres)
-
 				# Train G
-				netG.zero_grad()
-				
-				image_loss = mse(fake_img_hr, real_img_hr)
-				cache['g_loss'] += image_loss
-				
-				image_loss.backward()
-				optimizerG.step()
+				netG.zero_grad(set_to_none=True)
+
+				with torch.cuda.amp.autocast(enabled=torch.cuda.is_available(), dtype=autocast_dtype):
+					fake_img_hr = forwardG(lowres)
+					image_loss = mse(fake_img_hr, real_img_hr)
+				cache['g_loss'] += image_loss.detach()
+
+				scalerG.scale(image_loss).backward()
+				scalerG.step(optimizerG)
+				scalerG.update()
 
-				# Print information by tqdm
-				train_bar.set_description(desc='[%d/%d] Loss_G: %.4f' % (epoch, n_epoch_pretrain, image_loss))
+				# Print information by tqdm, reading the loss back syncs with the GPU
+				if i % 20 == 0:
+					train_bar.set_description(desc='[%d/%d] Loss_G: %.4f' % (epoch, n_epoch_pretrain, image_loss))
 				
 		# Save model parameters	
-		#if torch.cuda.is_available():
-		#	torch.save(netG.state_dict(), 'cp/netG_epoch_pre_gpu.pth')
-		#else:
-		#	torch.save(netG.state_dict(), 'cp/netG_epoch_pre_cpu.pth')
+		#save_async(checkpoint_executor, netG, 'cp/netG_epoch_pre_%s.pth' % (suffix))
 	
-	optimizerG = optim.Adam(netG.parameters())
-	optimizerD = optim.Adam(netD.parameters())
+	optimizerG = make_adam(netG.parameters())
+	optimizerD = make_adam(netD.parameters())
+	scalerG = torch.cuda.amp.GradScaler(enabled=use_scaler)
+	scalerD = torch.cuda.amp.GradScaler(enabled=use_scaler)
 	
 	if check_point != -1:
-		if torch.cuda.is_available():
-			netG.load_state_dict(torch.load('cp/netG_epoch_' + str(check_point) + '_gpu.pth'))
-			netD.load_state_dict(torch.load('cp/netD_epoch_' + str(check_point) + '_gpu.pth'))
-			optimizerG.load_state_dict(torch.load('cp/optimizerG_epoch_' + str(check_point) + '_gpu.pth'))
-			optimizerD.load_state_dict(torch.load('cp/optimizerD_epoch_' + str(check_point) + '_gpu.pth'))
-		else :
-			netG.load_state_dict(torch.load('cp/netG_epoch_' + str(check_point) + '_cpu.pth'))
-			netD.load_state_dict(torch.load('cp/netD_epoch_' + str(check_point) + '_cpu.pth'))
-			optimizerG.load_state_dict(torch.load('cp/optimizerG_epoch_' + str(check_point) + '_cpu.pth'))
-			optimizerD.load_state_dict(torch.load('cp/optimizerD_epoch_' + str(check_point) + '_cpu.pth'))
+		netG.load_state_dict(torch.load('cp/netG_epoch_%d_%s.pth' % (check_point, suffix)))
+		netD.load_state_dict(torch.load('cp/netD_epoch_%d_%s.pth' % (check_point, suffix)))
+		optimizerG.load_state_dict(torch.load('cp/optimizerG_epoch_%d_%s.pth' % (check_point, suffix)))
+		optimizerD.load_state_dict(torch.load('cp/optimizerD_epoch_%d_%s.pth' % (check_point, suffix)))
+	
+	n_train_batches = len(train_loader)
+	n_dev_batches = len(dev_loader)
+	
+	checkpoint_futures = []
+	image_futures = []
+	
+	# Label buffers, allocated on the device once the logits size is known
+	real_label = fake_label = flip_prob = ones = None
 	
 	for epoch in range(1 + max(check_point, 0), n_epoch + 1 + max(check_point, 0)):
 		train_bar = tqdm(train_loader)
@@ -133,49 +194,54 @@ def main():
 		netG.train()
 		netD.train()
 		
-		cache = {'mse_loss': 0, 'tv_loss': 0, 'adv_loss': 0, 'g_loss': 0, 'd_loss': 0, 'ssim': 0, 'psnr': 0, 'd_top_grad' : 0, 'd_bot_grad' : 0, 'g_top_grad' : 0, 'g_bot_grad' : 0}
+		# Running sums stay on the device, they are read back once per epoch
+		cache = {k: torch.zeros((), device=device) for k in ['mse_loss', 'tv_loss', 'adv_loss', 'g_loss', 'd_loss', 'ssim', 'psnr', 'd_top_grad', 'd_bot_grad', 'g_top_grad', 'g_bot_grad']}
 		
-		for lowres, real_img_hr in train_bar:
+		for i, (lowres, real_img_hr) in enumerate(train_bar):
 			#print ('lr size : ' + str(data.size()))
 			#print ('hr size : ' + str(target.size()))
 			if torch.cuda.is_available():
-				real_img_hr = real_img_hr.cuda()
-				lowres = lowres.cuda()
+				real_img_hr = real_img_hr.cuda(non_blocking=True).contiguous(memory_format=torch.channels_last)
+				lowres = lowres.cuda(non_blocking=True).contiguous(memory_format=torch.channels_last)
 			
 			# Train D
 			
 			#if not check_grads(netD, 'D'):
 			#	return
-			netD.zero_grad()
+			netD.zero_grad(set_to_none=True)
 			
-			logits_real = netD(real_img_hr)
-			logits_fake = netD(netG(lowres).detach())
-			
-			# Lable smoothing
-			real = torch.tensor(torch.rand(logits_real.size())*0.25 + 0.85)
-			fake = torch.tensor(torch.rand(logits_fake.size())*0.15)
-			
-			# Lable flipping
-			prob = (torch.rand(logits_real.size()) < 0.05)
+			# D returns raw logits, the sigmoid and BCE run in float32 outside autocast
+			with torch.cuda.amp.autocast(enabled=torch.cuda.is_available(), dtype=autocast_dtype):
+				logits_real = forwardD(real_img_hr, logits=True).float()
+				logits_fake = forwardD(forwardG(lowres).detach(), logits=True).float()
 			
 			#print ('logits real size : ' + str(logits_real.size()))
 			#print ('logits fake size : ' + str(logits_fake.size()))
 			
-			if torch.cuda.is_available():
-				real = real.cuda()
-				fake = fake.cuda()
-				prob = prob.cuda()
-				
-			real_clone = real.clone()
-			real[prob] = fake[prob]
-			fake[prob] = real_clone[prob]
-            
+			if real_label is None or real_label.size() != logits_real.size():
+				real_label = torch.empty_like(logits_real)
+				fake_label = torch.empty_like(logits_fake)
+				flip_prob = torch.empty_like(logits_real)
+				ones = torch.ones_like(logits_fake)
+			
+			# Lable smoothing
+			real_label.uniform_(0.85, 1.10)
+			fake_label.uniform_(0.0, 0.15)
+			
+			# Lable flipping, torch.where avoids the host sync of boolean indexing
+			prob = flip_prob.uniform_() < 0.05
+			real = torch.where(prob, fake_label, real_label)
+			fake = torch.where(prob, real_label, fake_label)
+			
 			d_loss = bce(logits_real, real) + bce(logits_fake, fake)
 			
-			cache['d_loss'] += d_loss.item()
+			cache['d_loss'] += d_loss.detach()
 			
-			d_loss.backward()
-			optimizerD.step()
+			scalerD.scale(d_loss).backward()
+			# Unscale first so the logged gradients are the real ones
+			scalerD.unscale_(optimizerD)
+			scalerD.step(optimizerD)
+			scalerD.update()
 			
 			dtg, dbg = get_grads_D(netD)
 
@@ -186,63 +252,65 @@ def main():
 					
 			#if not check_grads(netG, 'G'):
 			#	return
-			netG.zero_grad()
-			
-			fake_img_hr = netG(lowres)
-			image_loss = mse(fake_img_hr, real_img_hr)
+			netG.zero_grad(set_to_none=True)
 			
-			logits_fake_new = netD(fake_img_hr)
-			adversarial_loss = bce(logits_fake_new, torch.ones_like(logits_fake_new))
+			with torch.cuda.amp.autocast(enabled=torch.cuda.is_available(), dtype=autocast_dtype):
+				fake_img_hr = forwardG(lowres)
+				image_loss = mse(fake_img_hr, real_img_hr)
+				
+				logits_fake_new = forwardD(fake_img_hr, logits=True).float()
+			adversarial_loss = bce(logits_fake_new, ones)
 			
 			#tv_loss = tv(fake_img_hr)
 			
 			g_loss = image_loss + 1e-2*adversarial_loss
 
-			cache['mse_loss'] += image_loss.item()
-			#cache['tv_loss'] += tv_loss.item()
-			cache['adv_loss'] += adversarial_loss.item()
-			cache['g_loss'] += g_loss.item()
+			cache['mse_loss'] += image_loss.detach()
+			#cache['tv_loss'] += tv_loss.detach()
+			cache['adv_loss'] += adversarial_loss.detach()
+			cache['g_loss'] += g_loss.detach()
 
-			g_loss.backward()
-			optimizerG.step()
+			scalerG.scale(g_loss).backward()
+			scalerG.unscale_(optimizerG)
+			scalerG.step(optimizerG)
+			scalerG.update()
 			
 			gtg, gbg = get_grads_G(netG)
 
 			cache['g_top_grad'] += gtg
 			cache['g_bot_grad'] += gbg
 
-			# Print information by tqdm
-			train_bar.set_description(desc='[%d/%d] D grads:(%f, %f) G grads:(%f, %f) Loss_D: %.4f Loss_G: %.4f = %.4f + %.4f' % (epoch, n_epoch, dtg, dbg, gtg, gbg, d_loss, g_loss, image_loss, adversarial_loss))
+			# Print information by tqdm, reading the losses back syncs with the GPU
+			if i % 20 == 0:
+				train_bar.set_description(desc='[%d/%d] D grads:(%f, %f) G grads:(%f, %f) Loss_D: %.4f Loss_G: %.4f = %.4f + %.4f' % (epoch, n_epoch, dtg, dbg, gtg, gbg, d_loss, g_loss, image_loss, adversarial_loss))
 		
 		if use_tensorboard:
-			log_value('d_loss', cache['d_loss']/len(train_loader), epoch)
+			# Read all the epoch sums back with a single device to host copy
+			keys = ['d_loss', 'mse_loss', 'adv_loss', 'g_loss', 'd_top_grad', 'd_bot_grad', 'g_top_grad', 'g_bot_grad']
+			means = dict(zip(keys, (torch.stack([cache[k] for k in keys])/n_train_batches).tolist()))
+			
+			log_value('d_loss', means['d_loss'], epoch)
 		
-			log_value('mse_loss', cache['mse_loss']/len(train_loader), epoch)
-			#log_value('tv_loss', cache['tv_loss']/len(train_loader), epoch)
-			log_value('adv_loss', cache['adv_loss']/len(train_loader), epoch)
-			log_value('g_loss', cache['g_loss']/len(train_loader), epoch)
+			log_value('mse_loss', means['mse_loss'], epoch)
+			#log_value('tv_loss', means['tv_loss'], epoch)
+			log_value('adv_loss', means['adv_loss'], epoch)
+			log_value('g_loss', means['g_loss'], epoch)
 			
-			log_value('D top layer gradient', cache['d_top_grad']/len(train_loader), epoch)
-			log_value('D bot layer gradient', cache['d_bot_grad']/len(train_loader), epoch)
-			log_value('G top layer gradient', cache['g_top_grad']/len(train_loader), epoch)
-			log_value('G bot layer gradient', cache['g_bot_grad']/len(train_loader), epoch)
+			log_value('D top layer gradient', means['d_top_grad'], epoch)
+			log_value('D bot layer gradient', means['d_bot_grad'], epoch)
+			log_value('G top layer gradient', means['g_top_grad'], epoch)
+			log_value('G bot layer gradient', means['g_bot_grad'], epoch)
 		
-		# Save model parameters	
-		if torch.cuda.is_available():
-			torch.save(netG.state_dict(), 'cp/netG_epoch_%d_gpu.pth' % (epoch))
-			if epoch%5 == 0:
-				torch.save(netD.state_dict(), 'cp/netD_epoch_%d_gpu.pth' % (epoch))
-				torch.save(optimizerG.state_dict(), 'cp/optimizerG_epoch_%d_gpu.pth' % (epoch))
-				torch.save(optimizerD.state_dict(), 'cp/optimizerD_epoch_%d_gpu.pth' % (epoch))
-		else:
-			torch.save(netG.state_dict(), 'cp/netG_epoch_%d_cpu.pth' % (epoch))
-			if epoch%5 == 0:
-				torch.save(netD.state_dict(), 'cp/netD_epoch_%d_cpu.pth' % (epoch))
-				torch.save(optimizerG.state_dict(), 'cp/optimizerG_epoch_%d_cpu.pth' % (epoch))
-				torch.save(optimizerD.state_dict(), 'cp/optimizerD_epoch_%d_cpu.pth' % (epoch))
+		# Save model parameters, failing here if the previous epoch's writes failed
+		wait_all(checkpoint_futures)
+		checkpoint_futures.append(save_async(checkpoint_executor, netG, 'cp/netG_epoch_%d_%s.pth' % (epoch, suffix)))
+		if epoch%5 == 0:
+			checkpoint_futures.append(save_async(checkpoint_executor, netD, 'cp/netD_epoch_%d_%s.pth' % (epoch, suffix)))
+			checkpoint_futures.append(save_async(checkpoint_executor, optimizerG, 'cp/optimizerG_epoch_%d_%s.pth' % (epoch, suffix)))
+			checkpoint_futures.append(save_async(checkpoint_executor, optimizerD, 'cp/optimizerD_epoch_%d_%s.pth' % (epoch, suffix)))
 				
 		# Visualize results
-		with torch.no_grad():
+		with torch.inference_mode():
 			netG.eval()
 			out_path = 'vis/'
 			if not os.path.exists(out_path):
@@ -251,40 +319,61 @@ def main():
 			dev_bar = tqdm(dev_loader)
 			valing_results = {'mse': 0, 'ssims': 0, 'psnr': 0, 'ssim': 0, 'batch_sizes': 0}
 			dev_images = []
-			for val_lr, val_hr_restore, val_hr in dev_bar:
+			for i, (val_lr, val_hr_restore, val_hr) in enumerate(dev_bar):
 				batch_size = val_lr.size(0)
 				lr = val_lr
 				hr = val_hr
 				if torch.cuda.is_available():
-					lr = lr.cuda()
-					hr = hr.cuda()
+					lr = lr.cuda(non_blocking=True).contiguous(memory_format=torch.channels_last)
+					hr = hr.cuda(non_blocking=True).contiguous(memory_format=torch.channels_last)
 				
-				sr = netG(lr)
+				# Metrics are computed in float32
+				with torch.cuda.amp.autocast(enabled=torch.cuda.is_available(), dtype=autocast_dtype):
+					sr = netG(lr).float()
 				
-				psnr = 10 * log10(1 / ((sr - hr) ** 2).mean().item())
-				ssim = pytorch_ssim.ssim(sr, hr).item()
-				dev_bar.set_description(desc='[converting LR images to SR images] PSNR: %.4f dB SSIM: %.4f' % (psnr, ssim))
+				# Metrics stay on the device and are read back once per dev pass
+				mse_val = F.mse_loss(sr, hr)
+				psnr = 10 * torch.log10(1.0 / mse_val)
+				ssim = pytorch_ssim.ssim(sr, hr)
+				if i % 20 == 0:
+					dev_bar.set_description(desc='[converting LR images to SR images] PSNR: %.4f dB SSIM: %.4f' % (psnr, ssim))
 				
 				cache['ssim'] += ssim
 				cache['psnr'] += psnr
 				
 				# Avoid out of memory crash on 8G GPU
 				if len(dev_images) < 60 :
-					dev_images.extend([to_image()(val_hr_restore.squeeze(0)), to_image()(hr.data.cpu().squeeze(0)), to_image()(sr.data.cpu().squeeze(0))])
+					dev_images.extend([val_hr_restore.to(hr.device, non_blocking=True).squeeze(0), hr.squeeze(0), sr.squeeze(0)])
 			
 			dev_images = torch.stack(dev_images)
 			dev_images = torch.chunk(dev_images, dev_images.size(0) // 3)
 			
+			# The previous epoch's grids were encoded during this epoch's training
+			wait_all(image_futures)
 			dev_save_bar = tqdm(dev_images, desc='[saving training results]')
 			index = 1
 			for image in dev_save_bar:
-				image = utils.make_grid(image, nrow=3, padding=5)
-				utils.save_image(image, out_path + 'epoch_%d_index_%d.png' % (epoch, index), padding=5)
+				# Only the finished grids are copied back to the host
+				image = utils.make_grid(image.cpu(), nrow=3, padding=5)
+				image_futures.append(image_executor.submit(save_grid, image.numpy(), out_path + 'epoch_%d_index_%d.png' % (epoch, index)))
 				index += 1
 		
 			if use_tensorboard:			
-				log_value('ssim', cache['ssim']/len(dev_loader), epoch)
-				log_value('psnr', cache['psnr']/len(dev_loader), epoch)
+				ssim, psnr = (torch.stack([cache['ssim'], cache['psnr']])/n_dev_batches).tolist()
+				log_value('ssim', ssim, epoch)
+				log_value('psnr', psnr, epoch)
+	
+	wait_all(checkpoint_futures)
+	wait_all(image_futures)
 			
 if __name__ == '__main__':
-	main()
+	# Created here rather than at import time, since the spawned image workers re-import this module
+	checkpoint_executor = ThreadPoolExecutor(max_workers=1)
+	# PNG encoding of the dev results runs in worker processes, spawned rather than
+	# forked since the parent initializes CUDA. Each worker re-imports torch, so keep it to two
+	image_executor = ProcessPoolExecutor(max_workers=2, mp_context=multiprocessing.get_context('spawn'))
+	try:
+		main(checkpoint_executor, image_executor)
+	finally:
+		checkpoint_executor.shutdown(wait=True)
+		image_executor.shutdown(wait=True)
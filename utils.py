@@ -62,23 +62,50 @@ class DevDataset(Dataset):
 	def __len__(self):
 		return len(self.image_filenames)
 
+def to_cpu(obj):
+	# Copy every tensor of a (nested) state dict to the CPU, so the snapshot
+	# stays valid while training keeps updating the originals
+	if torch.is_tensor(obj):
+		return obj.detach().to('cpu', copy=True)
+	if isinstance(obj, dict):
+		return {k: to_cpu(v) for k, v in obj.items()}
+	if isinstance(obj, (list, tuple)):
+		return type(obj)(to_cpu(v) for v in obj)
+	return obj
+
+def cpu_state_dict(net):
+	# Works for optimizers too, anything with a state_dict()
+	return to_cpu(net.state_dict())
+
+def save_grid(grid, path):
+	# Meant for worker processes, the grid comes in as a numpy array so it pickles plainly
+	utils.save_image(torch.from_numpy(grid), path, padding=5)
+
 def print_first_parameter(net):	
 	for name, param in net.named_parameters():
 		if param.requires_grad:
 			print (str(name) + ':' + str(param.data[0]))
 			return
 
+def grad_stats(model):
+	# One fused reduction over all gradients, left on the device
+	grads = [p.grad for p in model.parameters() if not p.grad is None]
+	if not grads:
+		return None
+	grads = torch.nn.utils.parameters_to_vector(grads)
+	return torch.stack([grads.mean(), grads.abs().max()])
+
 def check_grads(model, model_name):
-	grads = []
-	for p in model.parameters():
-		if not p.grad is None:
-			grads.append(float(p.grad.mean()))
+	stats = grad_stats(model)
+	if stats is None:
+		return True
 
-	grads = np.array(grads)
-	if grads.any() and grads.mean() > 100:
+	# Single device to host copy
+	grads_mean, grads_max = stats.tolist()
+	if grads_mean > 100:
 		print('WARNING!' + model_name + ' gradients mean is over 100.')
 		return False
-	if grads.any() and grads.max() > 100:
+	if grads_max > 100:
 		print('WARNING!' + model_name + ' gradients max is over 100.')
 		return False
 		